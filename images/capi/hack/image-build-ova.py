@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 # Copyright 2019 The Kubernetes Authors.
 #
@@ -17,17 +17,43 @@
 ################################################################################
 # usage: image-build-ova.py [FLAGS] ARGS
 #  This program builds an OVA file from a VMDK and manifest file generated as a
-#  result of a Packer build.
+#  result of a Packer build. Python 3 is required.
 ################################################################################
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
 import os
+import re
+import shutil
+import stat
 import subprocess
-from string import Template
+import sys
 import tarfile
 
+# The size of the buffer used when reading large files such as the VMDK.
+_BUFSIZE = 1 << 20
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+# qemu-img is preferred over vmware-vdiskmanager for stream-optimizing the
+# VMDK files when it is installed.
+_QEMU_IMG = shutil.which('qemu-img')
+
+# The OpenSSL-backed SHA256 implementation uses the CPU's SHA extensions
+# (SHA-NI, ARMv8 crypto) when present. CPython falls back to its much slower
+# builtin _sha256 module when it is built without OpenSSL.
+try:
+    import _hashlib
+    _OPENSSL_SHA256 = hasattr(_hashlib, 'openssl_sha256')
+except ImportError:
+    _OPENSSL_SHA256 = False
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -43,6 +69,10 @@ def main():
     os.chdir(args.build_dir)
     print("image-build-ova: cd %s" % args.build_dir)
 
+    if not _OPENSSL_SHA256:
+        print("image-build-ova: warning: hashlib is not backed by OpenSSL, "
+              "checksums will be slow")
+
     # Load the packer manifest JSON
     data = None
     with open('packer-manifest.json', 'r') as f:
@@ -54,14 +84,15 @@ def main():
     print("image-build-ova: loaded %s-kube-%s" % (build['name'],
                                                   build_data['kubernetes_semver']))
 
-    # Get a list of the VMDK files from the packer manifest.
-    vmdk_files = get_vmdk_files(build['files'])
-
-    # Create stream-optimized versions of the VMDK files.
-    stream_optimize_vmdk_files(vmdk_files)
-
+    # Get the first VMDK file from the packer manifest.
     # TODO(akutz) Support multiple VMDK files in the OVF/OVA
-    vmdk = vmdk_files[0]
+    vmdk = get_first_vmdk_file(build['files'])
+
+    # Create a stream-optimized version of the VMDK file. Only the disk that
+    # goes into the OVA is converted. The remaining steps all wait on the
+    # conversion: the OVF records the stream-optimized size, the manifest
+    # needs the OVF and the VMDK checksum, and the OVA needs both.
+    stream_optimize_vmdk_file(vmdk)
 
     # Create the OVF file.
     ovf = "%s.ovf" % build['name']
@@ -86,73 +117,217 @@ def main():
     ova_manifest = "%s.mf" % build['name']
     create_ova_manifest(ova_manifest, [ovf, vmdk['stream_name']])
 
-    # Create the OVA.
+    # Create the OVA. The stream-optimized VMDK has to be staged on disk:
+    # qemu-img and vmware-vdiskmanager need a seekable output, each ustar
+    # header records its member's size up front, and OVF 1.x requires the
+    # descriptor and manifest (which needs the VMDK checksum) to come before
+    # the disk in the archive.
     ova = "%s.ova" % build['name']
     create_ova(ova, [ovf, ova_manifest, vmdk['stream_name']])
 
 
+def new_sha256():
+    # usedforsecurity=False (Python 3.9+) skips the FIPS wrappers some
+    # distributions add; the checksums are only used for integrity.
+    try:
+        return hashlib.new('sha256', usedforsecurity=False)
+    except TypeError:
+        return hashlib.new('sha256')
+
+
 def sha256(path):
-    m = hashlib.sha256()
-    with open(path, 'rb') as f:
+    with open(path, 'rb', buffering=0) as f:
+        # hashlib.file_digest (Python 3.11+) runs the read/update loop in C.
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, new_sha256).hexdigest()
+        # Otherwise reuse a single buffer instead of allocating a new bytes
+        # object for every chunk.
+        m = new_sha256()
+        buf = bytearray(_BUFSIZE)
+        mv = memoryview(buf)
         while True:
-            data = f.read(65536)
-            if not data:
+            n = f.readinto(buf)
+            if not n:
                 break
-            m.update(data)
+            m.update(mv[:n])
     return m.hexdigest()
 
 
+class HashingWriter(object):
+    """A file object wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = new_sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+
 def create_ova(path, infile_paths):
     print("image-build-ova: create ova %s" % path)
+    # Build every header before the OVA is opened, so a member that cannot be
+    # stored fails the build without leaving a partial archive behind.
+    members = [ova_member_header(p) for p in infile_paths]
+
+    # Hash the OVA while it is written instead of reading it back afterwards.
     with open(path, 'wb') as f:
-        with tarfile.open(fileobj=f, mode='w|') as tar:
-            for infile_path in infile_paths:
-                tar.add(infile_path)
+        hw = HashingWriter(f)
+        for info, header in members:
+            write_ova_member(hw, info, header)
+        # End the archive with two zero blocks, padded to a full record.
+        end = f.tell() + 2 * tarfile.BLOCKSIZE
+        hw.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE +
+                                -end % tarfile.RECORDSIZE))
 
     chksum_path = "%s.sha256" % path
     print("image-build-ova: create ova checksum %s" % chksum_path)
-    with open(chksum_path, 'w') as f:
-        f.write(sha256(path))
+    write_file(chksum_path, hw.hash.hexdigest().encode('utf-8'))
+
+
+def ova_member_header(path):
+    # OVA files must use the ustar format, which cannot store members of
+    # 8 GiB or more, or names longer than 100 characters that cannot be split
+    # at a "/".
+    st = os.stat(path)
+    info = tarfile.TarInfo(path)
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    if pwd:
+        try:
+            info.uname = pwd.getpwuid(st.st_uid)[0]
+        except KeyError:
+            pass
+    if grp:
+        try:
+            info.gname = grp.getgrgid(st.st_gid)[0]
+        except KeyError:
+            pass
+    if info.size >= 8 << 30:
+        raise ValueError("cannot add %s to the OVA: ustar members must be "
+                         "smaller than 8 GiB" % path)
+    try:
+        return info, info.tobuf(format=tarfile.USTAR_FORMAT)
+    except ValueError as e:
+        raise ValueError("cannot add %s to the OVA: %s" % (path, e))
+
+
+def write_ova_member(f, info, header):
+    # The header is emitted by hand and the contents are copied straight from
+    # the file through a single reused buffer, avoiding tarfile's stream
+    # buffering on the multi-GB VMDK.
+    f.write(header)
+    with open(info.name, 'rb', buffering=0) as src:
+        fd = src.fileno()
+        if hasattr(os, 'posix_fadvise'):
+            # Ask the kernel for a larger readahead window.
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # Copy exactly the size recorded in the header, even if the file
+        # changes while it is read.
+        buf = bytearray(_BUFSIZE)
+        mv = memoryview(buf)
+        remaining = info.size
+        while remaining:
+            n = src.readinto(mv[:min(remaining, _BUFSIZE)])
+            if not n:
+                raise OSError("unexpected end of data: %s" % info.name)
+            f.write(mv[:n])
+            remaining -= n
+
+        if hasattr(os, 'posix_fadvise'):
+            # The member is not read again, so drop it from the page cache.
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    remainder = info.size % tarfile.BLOCKSIZE
+    if remainder:
+        f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
 
 
 def create_ovf(path, data):
     print("image-build-ova: create ovf %s" % path)
-    with open(path, 'w') as f:
-        f.write(Template(_OVF_TEMPLATE).substitute(data))
+    out = [_OVF_LITERALS[0]]
+    for key, literal in zip(_OVF_KEYS, _OVF_LITERALS[1:]):
+        out += (str(data[key]).encode('utf-8'), literal)
+    write_file(path, b''.join(out))
 
 
 def create_ova_manifest(path, infile_paths):
     print("image-build-ova: create ova manifest %s" % path)
-    with open(path, 'w') as f:
-        for i in infile_paths:
-            f.write('SHA256(%s)= %s\n' % (i, sha256(i)))
-
-
-def get_vmdk_files(inlist):
-    outlist = []
-    for f in inlist:
-        if f['name'].endswith('.vmdk'):
-            outlist.append(f)
-    return outlist
-
-
-def stream_optimize_vmdk_files(inlist):
-    for f in inlist:
-        infile = f['name']
-        outfile = infile.replace('.vmdk', '.ova.vmdk', 1)
-        if os.path.isfile(outfile):
-            os.remove(outfile)
+    # hashlib releases the GIL while hashing, so the files are hashed
+    # concurrently.
+    with ThreadPoolExecutor(max_workers=min(4, len(infile_paths))) as ex:
+        digests = list(ex.map(sha256, infile_paths))
+    manifest = ''.join('SHA256(%s)= %s\n' % (i, digest)
+                       for i, digest in zip(infile_paths, digests))
+    write_file(path, manifest.encode('utf-8'))
+
+
+def write_file(path, data):
+    # Small generated files are written with a single write() rather than
+    # through the buffered text layer.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        mv = memoryview(data)
+        while mv:
+            mv = mv[os.write(fd, mv):]
+    finally:
+        os.close(fd)
+
+
+def get_first_vmdk_file(inlist):
+    return next(f for f in inlist if f['name'].endswith('.vmdk'))
+
+
+def qemu_img_convert_args(infile, outfile):
+    # Commas are escaped for --image-opts.
+    opts = 'driver=vmdk,file.driver=file,file.filename=%s' % (
+        infile.replace(',', ',,'))
+    # Reading the source with io_uring and O_DIRECT needs Linux, QEMU 5.0+
+    # built with liburing, and a filesystem that supports O_DIRECT. Opening
+    # the source with "qemu-img info" is quick, so check up front that
+    # qemu-img accepts those options instead of failing the conversion.
+    fast_opts = opts + ',file.aio=io_uring,cache.direct=on'
+    if sys.platform.startswith('linux') and subprocess.call(
+            [_QEMU_IMG, 'info', '--image-opts', fast_opts],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+        opts = fast_opts
+    # Use eight parallel coroutines.
+    return [
+        _QEMU_IMG, 'convert', '-p',
+        '-m', '8',
+        '-O', 'vmdk',
+        '-o', 'subformat=streamOptimized,adapter_type=lsilogic',
+        '--image-opts', opts,
+        outfile
+    ]
+
+
+def stream_optimize_vmdk_file(f):
+    infile = f['name']
+    outfile = infile.replace('.vmdk', '.ova.vmdk', 1)
+    try:
+        os.unlink(outfile)
+    except FileNotFoundError:
+        pass
+    if _QEMU_IMG:
+        args = qemu_img_convert_args(infile, outfile)
+    else:
         args = [
             'vmware-vdiskmanager',
             '-r', infile,
             '-t', '5',
             outfile
         ]
-        print("image-build-ova: stream optimize %s --> %s (1-2 minutes)" %
-              (infile, outfile))
-        subprocess.check_call(args)
-        f['stream_name'] = outfile
-        f['stream_size'] = os.path.getsize(outfile)
+    print("image-build-ova: stream optimize %s --> %s (1-2 minutes)" %
+          (infile, outfile))
+    subprocess.check_call(args)
+    f['stream_name'] = outfile
+    f['stream_size'] = os.path.getsize(outfile)
 
 
 _OVF_TEMPLATE = '''<?xml version='1.0' encoding='UTF-8'?>
@@ -555,5 +730,12 @@ EVALUATION LICENSE.  If You are licensing the Software for evaluation purposes,
 </Envelope>
 '''
 
+# The OVF template is split once into its encoded literal text and the
+# placeholder names between them, so create_ovf only joins bytes. The template
+# only uses the ${NAME} placeholder form and $$ escapes.
+_OVF_PARTS = re.split(r'\$\{(\w+)\}', _OVF_TEMPLATE)
+_OVF_LITERALS = [p.replace('$$', '$').encode('utf-8') for p in _OVF_PARTS[::2]]
+_OVF_KEYS = _OVF_PARTS[1::2]
+
 if __name__ == "__main__":
     main()